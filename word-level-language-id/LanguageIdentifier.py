@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
-import math
+import functools
+
+import numpy as np
 
 from LanguageModel import LanguageModel
+from _viterbi_numba import viterbi_forward
 
 class LanguageIdentifier:
     """Word level language identification.
@@ -15,11 +18,19 @@ class LanguageIdentifier:
     # assignment, e.g. punctuation.
     IGNORE = "##IGNORE##"
 
+    # Maximum number of words for which weighted scores are cached.
+    SCORE_CACHE_SIZE = 65536
+
+    # Initial number of tokens the emission buffer can hold.
+    EMISSION_BUFFER_SIZE = 256
+
     def __init__(self,
                  fr, en,
                  model_file_fr, model_file_en,
                  lex_file_fr, lex_file_en,
-                 lex_weight=1):
+                 lex_weight=1,
+                 transition_probability=0.78,
+                 start_probability=0.75):
         """Initialises the language model.
 
         Args:
@@ -27,16 +38,37 @@ class LanguageIdentifier:
             model_file_fr/en (str): Foreign/English LanguageModel file name.
             lex_file_fr/en (str): Foreign/English Lexicon (1 word + frequency per line).
             lex_weight (float): Weight of the lexicon vs. the character model.
+            transition_probability (float): Default Viterbi transition probability.
+            start_probability (float): Default Viterbi start probability.
         """
         self.lex_weight = lex_weight
         self.model = {}
         self.model[self.FR] = LanguageModel.load(model_file_fr, lex_file_fr, lex_weight)
         self.model[self.EN] = LanguageModel.load(model_file_en, lex_file_en, lex_weight)
 
+        # Log weights of the lexicon and character model
+        with np.errstate(divide='ignore'):
+            self._log_lex_weight = np.log(lex_weight)
+            self._log_char_weight = np.log(1 - lex_weight)
+
+        # Log transition matrix and start vector for Viterbi, recomputed by
+        # _viterbi_log_probabilities() only if other probabilities are requested.
+        self.transition_probability = transition_probability
+        self.start_probability = start_probability
+        self._viterbi_probabilities = None
+        self._viterbi_log_probabilities(transition_probability, start_probability)
+
+        # Per-word cache of the weighted scores, the models and weights above
+        # must not be changed after initialisation.
+        self.score = functools.lru_cache(maxsize=self.SCORE_CACHE_SIZE)(self._score)
+
+        # Reusable buffer for the emission scores of a token sequence.
+        self._emission_buf = np.empty((self.EMISSION_BUFFER_SIZE, 2), dtype=np.float32)
+
     def identify(self, tokens,
                  method="viterbi",
-                 transition_probability=0.78,
-                 start_probability=0.75):
+                 transition_probability=None,
+                 start_probability=None):
         """Word level language identification of a token sequence.
 
         Args:
@@ -46,16 +78,17 @@ class LanguageIdentifier:
             VITERBI
             transition_probability (float):
                 Probability that the following token will be in the same language.
+                Defaults to the value given at initialisation.
             start_probability (float):
-                Probability that the first token will be Foreign
+                Probability that the first token will be Foreign.
+                Defaults to the value given at initialisation.
 
         Returns:
             languages (str[]): List of language assignments matching the token list.
                                E.g. ["fr", "fr", "en", ...]
         """
 
-        # Special treatment for the Irish affirmative "sea" in 1-word sentences.
-        if self.FR == 'ga' and len(tokens) == 1 and tokens[0].lower() == "sea":
+        if self._is_irish_sea(tokens):
             return [self.FR]
 
         if method == "independent":
@@ -65,117 +98,221 @@ class LanguageIdentifier:
                                          transition_probability,
                                          start_probability)
 
-    def identify_independent(self, tokens):
-        """Independent word level language identification without any context.
+    def identify_many(self, sentences,
+                      method="viterbi",
+                      transition_probability=None,
+                      start_probability=None):
+        """Word level language identification of multiple token sequences.
 
-        For each token, picks the language with the higher probability according
-        to the language models.
+        Same as calling identify() for each sentence, but every distinct token
+        is scored only once for the whole batch.
+
+        Args:
+            sentences (str[][]): A list of token lists
+            method, transition_probability, start_probability: See identify()
+
+        Returns:
+            languages (str[][]): List of language assignments for each sentence.
         """
+        if method not in ["independent", "viterbi"]:
+            raise ValueError("Unknown method: %s" % method)
+
+        sentences = [list(tokens) for tokens in sentences]
+        langs = [self.FR, self.EN]
+        log_trans, log_start = self._viterbi_log_probabilities(transition_probability,
+                                                               start_probability)
+
+        # Emission scores of all distinct tokens in a shared array
+        token_index = {}
+        for tokens in sentences:
+            for token in tokens:
+                token_index.setdefault(token, len(token_index))
+        emissions = np.array([self.score(token) for token in token_index],
+                             dtype=np.float32).reshape(-1, 2)
 
         languages = []
-        for token in tokens:
-            scores = self.score(token)
-            if scores[self.FR] >= scores[self.EN]:
-                languages.append(self.FR)
+        for tokens in sentences:
+            if not tokens:
+                languages.append([])
+                continue
+            if self._is_irish_sea(tokens):
+                languages.append([self.FR])
+                continue
+            E = emissions[[token_index[token] for token in tokens]]
+            if method == "independent":
+                path = (E[:, 1] > E[:, 0]).astype(np.int8)
             else:
-                languages.append(self.EN)
+                path = self._viterbi_path(E, log_trans, log_start)
+            languages.append([langs[i] for i in path])
 
         return languages
 
+    def _is_irish_sea(self, tokens):
+        """Special treatment for the Irish affirmative "sea" in 1-word sentences.
+        """
+        return self.FR == 'ga' and len(tokens) == 1 and tokens[0].lower() == "sea"
+
+    def identify_independent(self, tokens):
+        """Independent word level language identification without any context.
+
+        For each token, picks the language with the higher probability according
+        to the language models.
+        """
+
+        E = self._score_batch(tokens)
+        return [self.FR if fr >= en else self.EN for fr, en in E]
+
     def identify_viterbi(self, tokens,
-                         transition_probability=0.9,
-                         start_probability=0.5):
+                         transition_probability=None,
+                         start_probability=None):
         """Context-dependent word level language identification using Viterbi.
 
         Assigns the most likely language to each token according to both language
         models and the likelihood of switching the language or not.
         """
 
-        languages = []
-
-        V = [{}] # Stores max probability for each token and language
-        S = [{}] # Stores argmax (most likely language)
-
-        # Probability of keeping vs. switching the language
-        trans_p = {}
-        trans_p[self.FR] = {}
-        trans_p[self.EN] = {}
-        trans_p[self.FR][self.FR] = transition_probability
-        trans_p[self.EN][self.EN] = transition_probability
-        trans_p[self.FR][self.EN] = 1 - transition_probability
-        trans_p[self.EN][self.FR] = 1 - transition_probability
-
-        # Initial probabilities for both languages
-        scores = self.score(tokens[0])
-        V[0][self.FR] = math.log(start_probability) + scores[self.FR]
-        V[0][self.EN] = math.log(1 - start_probability) + scores[self.EN]
+        langs = [self.FR, self.EN]
+        log_trans, log_start = self._viterbi_log_probabilities(transition_probability,
+                                                               start_probability)
+
+        # Emission scores of each token for both languages
+        E = self._score_batch(tokens)
+        path = self._viterbi_path(E, log_trans, log_start)
+        return [langs[i] for i in path]
+
+    def identify_viterbi_streaming(self, tokens,
+                                   window=2048,
+                                   overlap=64,
+                                   transition_probability=None,
+                                   start_probability=None):
+        """Viterbi language identification of long token sequences in windows.
+
+        Decodes overlapping windows of at most <window> tokens independently,
+        so that memory use does not grow with the sequence length. The first
+        and last <overlap> tokens of each window only serve as context and
+        their languages are taken from the neighbouring windows instead. With
+        the usual high transition probabilities, the result matches
+        identify_viterbi() except in rare cases close to the window borders.
+        """
+        if window <= 2 * overlap:
+            raise ValueError("window must be larger than twice the overlap")
+        if self._is_irish_sea(tokens):
+            return [self.FR]
 
+        T = len(tokens)
         langs = [self.FR, self.EN]
+        log_trans, log_start = self._viterbi_log_probabilities(transition_probability,
+                                                               start_probability)
 
-        # Iterate over tokens (starting at second token)
-        for t in range(1, len(tokens)):
-            V.append({})
-            S.append({})
-            # Iterate over the two languages
-            scores = self.score(tokens[t])
-            for lang in langs:
-                # Get max and argmax for current position
-                term = (V[t-1][lang2] + math.log(trans_p[lang2][lang]) + scores[lang]
-                        for lang2 in langs)
-                maxlang, prob = self.max_argmax(term)
-                V[t][lang] = prob
-                S[t][lang] = langs[maxlang]
-
-        # Get argmax for final token
-        languages = [0] * len(tokens)
-        languages[-1] = langs[self.max_argmax(V[-1][lang] for lang in langs)[0]]
-
-        # Reconstruct optimal path
-        for t in range(len(tokens)-1, 0, -1):
-            languages[t-1] = S[t][languages[t]]
+        # Number of tokens whose language is kept from each window
+        step = window - 2 * overlap
+        languages = []
+        start = 0
+        while start < T:
+            lo = max(start - overlap, 0)
+            hi = min(start + step + overlap, T)
+            end = T if hi == T else start + step
+            path = self._viterbi_path(self._score_batch(tokens[lo:hi]),
+                                      log_trans, log_start)
+            languages.extend(langs[i] for i in path[start-lo:end-lo])
+            start = end
 
         return languages
 
-    def max_argmax(self, iterable):
-        """Returns the tuple (argmax, max) for a list
+    def _viterbi_path(self, E, log_trans, log_start):
+        """Returns the most likely state sequence (0 = Foreign, 1 = English).
         """
-        return max(enumerate(iterable), key=lambda x: x[1])
-
-    def score(self, word):
+        T = len(E)
+        # Forward pass, keeping the scores of the final token and backpointers
+        # (most likely previous language) for every token.
+        v, bp = viterbi_forward(E, log_trans, log_start)
+
+        # Get argmax for final token and reconstruct optimal path
+        path = np.empty(T, dtype=np.int8)
+        path[-1] = v.argmax()
+        for t in range(T-1, 0, -1):
+            path[t-1] = bp[t, path[t]]
+        return path
+
+    def _viterbi_log_probabilities(self, transition_probability=None,
+                                   start_probability=None):
+        """Returns the log transition matrix and log start vector for Viterbi.
+
+        log_trans[i][j] is the log probability of switching from language i
+        to language j and log_start[i] that of starting in language i, where
+        index 0 is Foreign and 1 is English. None selects the default
+        probabilities, cached arrays are reused if the probabilities match.
+        """
+        if transition_probability is None:
+            transition_probability = self.transition_probability
+        if start_probability is None:
+            start_probability = self.start_probability
+
+        if self._viterbi_probabilities != (transition_probability, start_probability):
+            self._log_trans = np.log(np.array(
+                [[transition_probability, 1 - transition_probability],
+                 [1 - transition_probability, transition_probability]]))
+            self._log_start = np.log(np.array(
+                [start_probability, 1 - start_probability]))
+            self._viterbi_probabilities = (transition_probability, start_probability)
+        return self._log_trans, self._log_start
+
+    def _score(self, word):
         """Returns the weighted log probability according to lexicon + character model.
+
+        Use the cached score() instead. The result is the tuple
+        (Foreign score, English score).
         """
         # Punctuation etc. have no influence on the language assignment
         if word == self.IGNORE:
-            return {self.FR: 1, self.EN: 1}
+            return 0.0, 0.0
 
-        lex_score, char_score = {}, {}
-        for lang in [self.FR, self.EN]:
-            lex_score[lang] = math.exp(self.model[lang].lex_score(word))
-            char_score[lang] = math.exp(self.model[lang].char_score(word))
+        lex_fr, char_fr = self.model[self.FR].score(word)
+        lex_en, char_en = self.model[self.EN].score(word)
 
         # Relative scores, only these can be weighted
-        lex_score_rel, char_score_rel = {}, {}
-        for lang in [self.FR, self.EN]:
-            lex_score_rel[lang] = lex_score[lang] / (lex_score[self.FR] +
-                                                     lex_score[self.EN])
-            char_score_rel[lang] = char_score[lang] / (char_score[self.FR] +
-                                                       char_score[self.EN])
-
-        weighted_score = {}
-        # If neither word is in the lexicon, use only the character model
-        if (lex_score[self.FR] == math.exp(self.model[self.FR].lex_score(LanguageModel.OOV)) and
-            lex_score[self.EN] == math.exp(self.model[self.EN].lex_score(LanguageModel.OOV))):
-            for lang in [self.FR, self.EN]:
-                weighted_score[lang] = math.log(char_score_rel[lang])
+        char_norm = np.logaddexp(char_fr, char_en)
+        char_rel_fr, char_rel_en = char_fr - char_norm, char_en - char_norm
+
+        # If neither word is in the lexicon, use only the character model.
+        # Lexicon scores are compared in log space: the model returns exactly
+        # oov_lex_log for unknown words.
+        if (lex_fr == self.model[self.FR].oov_lex_log and
+            lex_en == self.model[self.EN].oov_lex_log):
+            return float(char_rel_fr), float(char_rel_en)
+
         # Else combine both models
-        else:
-            for lang in [self.FR, self.EN]:
-                weighted_score[lang] = math.log(self.lex_weight * lex_score_rel[lang] +
-                                                (1 - self.lex_weight) * char_score_rel[lang])
-        #print word
-        #print("%.15f %.15f" % (lex_score[self.FR], lex_score[self.EN]))
-        #print("%.15f %.15f" % (char_score[self.FR], char_score[self.EN]))
-        #print("%.15f %.15f" % (lex_score_rel[self.FR], lex_score_rel[self.EN]))
-        #print("%.15f %.15f" % (char_score_rel[self.FR], char_score_rel[self.EN]))
-        #print("%.15f %.15f" % (weighted_score[self.FR], weighted_score[self.EN]))
+        lex_norm = np.logaddexp(lex_fr, lex_en)
+        return (float(np.logaddexp(self._log_lex_weight + lex_fr - lex_norm,
+                                   self._log_char_weight + char_rel_fr)),
+                float(np.logaddexp(self._log_lex_weight + lex_en - lex_norm,
+                                   self._log_char_weight + char_rel_en)))
+
+    def score_batch(self, tokens):
+        """Returns the weighted log probabilities of a token sequence.
+
+        The result is a float32 array of shape (T, 2) with the Foreign scores
+        in column 0 and the English scores in column 1, gathered from the
+        cached score().
+        """
+        return self._score_batch(tokens).copy()
+
+    def _score_batch(self, tokens):
+        """Same as score_batch(), but returns a view of the emission buffer.
+
+        The result is only valid until the next call.
+        """
+        weighted_score = self._emission_buffer(len(tokens))
+        if tokens:
+            weighted_score[:] = [self.score(token) for token in tokens]
         return weighted_score
+
+    def _emission_buffer(self, T):
+        """Returns a contiguous (T, 2) float32 view of the emission buffer.
+
+        The buffer is only reallocated (doubling in size) if T exceeds it.
+        """
+        if T > len(self._emission_buf):
+            self._emission_buf = np.empty((max(T, 2 * len(self._emission_buf)), 2),
+                                          dtype=np.float32)
+        return self._emission_buf[:T]
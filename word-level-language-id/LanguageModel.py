@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import array
+import bisect
 import codecs
+import functools
 import json
 import math
+import zipfile
+from collections import Counter
+
+import numpy as np
 
 class LanguageModel:
     """Language model based on a lexicon and a character n-gram Markov model.
@@ -24,6 +31,10 @@ class LanguageModel:
     # but "Is" will rather start an Irish and "A" an English one.
     CASE_SENSITIVITY_THRESHOLD = 4
 
+    # Maximum number of words for which lexicon and character model scores
+    # are cached.
+    CACHE_SIZE = 100000
+
     def __init__(self, language, n, lex_file, lex_weight=1):
         """Initialises the language model.
 
@@ -44,23 +55,91 @@ class LanguageModel:
         self.start_prob = {}
         # Probabilities of transitions between ngrams.
         # This is a nested dictionary, e.g. trans_prob["bai"]["ail"]
+        # start_prob and trans_prob are only filled by train() and load_json().
         self.trans_prob = {}
+        # Indexed versions of start_prob and trans_prob built by index_ngrams():
+        # maps each ngram to its index, with unk_index for unseen ngrams.
+        self.ngram_index = {}
+        self.unk_index = 0
+        # Start log probability of each ngram.
+        self.start_log = None
+        # Log probability of an unseen transition from each ngram.
+        self.trans_default = None
+        # Log probabilities of seen transitions in CSR layout: those from
+        # ngram i are trans_vals[trans_ptr[i]:trans_ptr[i+1]], to the ngrams
+        # in the same (sorted) range of trans_cols.
+        self.trans_ptr = None
+        self.trans_cols = None
+        self.trans_vals = None
+        # start_log, trans_default and trans_vals are views of this array.
+        self.ngram_log = None
+        # Memoryviews for fast scalar lookups.
+        self._log_view = None
+        self._ptr_view = None
+        self._cols_view = None
         # Stores relative lexicon frequency of every word.
         self.lex = self.load_lexicon(lex_file)
+        # Log probability of out-of-lexicon words.
+        self.oov_lex_log = self.lex[self.OOV]
+
+        # Per-word caches of lex_score() and char_score().
+        self.clear_cache()
+
+    def clear_cache(self):
+        """Resets the word score caches, needed whenever the model changes.
+        """
+        self.lex_score = functools.lru_cache(maxsize=self.CACHE_SIZE)(self._lex_score)
+        self._cached_char_score = functools.lru_cache(maxsize=self.CACHE_SIZE)(self._char_score)
 
     def dump(self, file_name=None):
-        """Saves the language model to the specified file in JSON format"""
+        """Saves the language model to the specified file in compressed NumPy format.
+
+        The seen transitions are stored as (row, column, value) triplets.
+        """
         if file_name is None:
             file_name = self.language + ".model"
-        with open(file_name, "w") as f:
-            json.dump([self.language, self.n,
-                       self.start_prob, self.trans_prob], f)
+        K = self.unk_index + 1
+        rows = np.repeat(np.arange(K, dtype=np.int32), np.diff(self.trans_ptr))
+        ngrams = sorted(self.ngram_index, key=self.ngram_index.get)
+        # Write to a file object, np.savez would append ".npz" to a file name
+        with open(file_name, "wb") as f:
+            np.savez_compressed(f,
+                                language=self.language,
+                                n=self.n,
+                                ngrams=np.array(ngrams, dtype=str),
+                                start_log=self.start_log,
+                                trans_default=self.trans_default,
+                                trans_rows=rows,
+                                trans_cols=self.trans_cols,
+                                trans_vals=self.trans_vals)
         print("Saved model at: %s" % file_name)
 
     @classmethod
     def load(cls, model_file, lex_file, lex_weight=1):
         """Loads the language model from the specified file
 
+        Models saved in the JSON format of earlier versions can be loaded as well.
+
+        Args:
+            model_file (str): LanguageModel file name
+            lex_file (str): Frequency lexicon file name
+            lex_weight (float): Weight of the lexicon vs. the character model.
+        """
+        if not zipfile.is_zipfile(model_file):
+            return cls.load_json(model_file, lex_file, lex_weight)
+
+        with np.load(model_file) as z:
+            model = cls(str(z["language"]), int(z["n"]), lex_file, lex_weight)
+            model.ngram_index = {ngram: i for i, ngram in enumerate(z["ngrams"].tolist())}
+            model.unk_index = len(model.ngram_index)
+            model._set_ngram_log(z["start_log"], z["trans_default"],
+                                 z["trans_rows"], z["trans_cols"], z["trans_vals"])
+        return model
+
+    @classmethod
+    def load_json(cls, model_file, lex_file, lex_weight=1):
+        """Loads the language model from a file in the earlier JSON format
+
         Args:
             model_file (str): LanguageModel file name
             lex_file (str): Frequency lexicon file name
@@ -71,17 +150,113 @@ class LanguageModel:
             model = cls(language, n, lex_file, lex_weight)
             model.start_prob = start_prob
             model.trans_prob = trans_prob
+            model.index_ngrams()
             return model
 
+    def index_ngrams(self):
+        """Builds indexed versions of the start and transition probabilities.
+
+        start_log[i] holds the log probability of ngram i starting a word and
+        transition() that of ngram i being followed by ngram j. Unseen
+        transitions from ngram i get trans_default[i]; the smoothed UNKNOWN
+        values are filled in for unseen ngrams. Transitions are stored
+        sparsely, a dense K x K matrix would not fit for longer ngrams.
+        """
+        ngrams = set(self.start_prob) | set(self.trans_prob)
+        for next_ngrams in self.trans_prob.values():
+            ngrams.update(next_ngrams)
+        ngrams.discard(self.UNKNOWN)
+        self.ngram_index = {ngram: i for i, ngram in enumerate(sorted(ngrams))}
+        self.unk_index = len(self.ngram_index)
+        K = self.unk_index + 1
+
+        start_log = np.full(K, self.start_prob[self.UNKNOWN])
+        for ngram, logp in self.start_prob.items():
+            start_log[self.ngram_index.get(ngram, self.unk_index)] = logp
+
+        trans_default = np.full(K, self.trans_prob[self.UNKNOWN][self.UNKNOWN])
+        rows, cols, vals = [], [], []
+        for ngram, next_ngrams in self.trans_prob.items():
+            if ngram == self.UNKNOWN:
+                continue
+            i = self.ngram_index[ngram]
+            trans_default[i] = next_ngrams[self.UNKNOWN]
+            for next_ngram, logp in next_ngrams.items():
+                if next_ngram != self.UNKNOWN:
+                    rows.append(i)
+                    cols.append(self.ngram_index[next_ngram])
+                    vals.append(logp)
+
+        self._set_ngram_log(start_log, trans_default, rows, cols, vals)
+
+    def _set_ngram_log(self, start_log, trans_default, rows, cols, vals):
+        """Stores the indexed start and transition probabilities, see index_ngrams().
+
+        All log probabilities are converted to float32 and kept in the single
+        contiguous array ngram_log. The seen transitions (rows[k] -> cols[k]
+        with log probability vals[k]) are sorted into CSR layout.
+        """
+        K = self.unk_index + 1
+        rows = np.asarray(rows, dtype=np.int32)
+        cols = np.asarray(cols, dtype=np.int32)
+        order = np.lexsort((cols, rows))
+
+        self.ngram_log = np.empty(2 * K + len(order), dtype=np.float32)
+        self.start_log = self.ngram_log[:K]
+        self.trans_default = self.ngram_log[K:2*K]
+        self.trans_vals = self.ngram_log[2*K:]
+        self.start_log[:] = start_log
+        self.trans_default[:] = trans_default
+        self.trans_vals[:] = np.asarray(vals)[order]
+
+        self.trans_ptr = np.zeros(K + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows, minlength=K), out=self.trans_ptr[1:])
+        self.trans_cols = np.ascontiguousarray(cols[order])
+
+        self._log_view = memoryview(self.ngram_log)
+        self._ptr_view = memoryview(self.trans_ptr)
+        self._cols_view = memoryview(self.trans_cols)
+        self.clear_cache()
+
+    def transition(self, i, j):
+        """Returns the log probability of ngram index i being followed by j.
+
+        The second element of the returned tuple tells whether the transition
+        was seen in training.
+        """
+        lo, hi = self._ptr_view[i], self._ptr_view[i+1]
+        k = bisect.bisect_left(self._cols_view, j, lo, hi)
+        if k < hi and self._cols_view[k] == j:
+            return self._log_view[2 * (self.unk_index + 1) + k], True
+        return self._log_view[self.unk_index + 1 + i], False
+
     @classmethod
     def word2ngrams(cls, word, n):
         """Splits a word into a list of character ngrams, adding start and end symbols.
         word2ngram("agus", 3) = ["<ag", "agu", "gus", "us>"]
         """
+        word = cls.pad(word, n)
+        return [word[i:i+n] for i in range(len(word)-n+1)]
+
+    @classmethod
+    def pad(cls, word, n):
+        """Adds start and end symbols to a word, twice for ngrams of length >= 4.
+        """
         word = cls.START + word + cls.END
         if n >= 4:
             word = cls.START + word + cls.END
-        return [word[i:i+n] for i in range(len(word)-n+1)]
+        return word
+
+    def word2ngram_ids(self, word):
+        """Returns the ngram_index indices of the character ngrams of a word.
+
+        Same ngrams as word2ngrams(), as a compact array of C ints.
+        """
+        n = self.n
+        word = self.pad(word, n)
+        get = self.ngram_index.get
+        return array.array('i', [get(word[i:i+n], self.unk_index)
+                                 for i in range(len(word)-n+1)])
 
     def load_lexicon(self, lex_file):
         """Loads the frequency lexicon into the language model.
@@ -89,55 +264,85 @@ class LanguageModel:
         lamb = 0.1 # smoothing value
 
         with codecs.open(lex_file, encoding='utf-8') as f:
-            lex = {}
-            total = 0
-            for line in f:
-                fields = line.strip().split()
-                word = fields[0]
-                if len(fields[0]) >= self.CASE_SENSITIVITY_THRESHOLD:
-                    word = fields[0].lower()
-                lex[word] = lex.get(word, lamb) + int(fields[1])
-                total += int(fields[1])
-            # Add out-of-lexicon word
-            lex[self.OOV] = lamb
-
-            for word in lex:
-                lex[word] = math.log(lex[word] / float(total + lamb * (len(lex))))
-            return lex
-        return None
-
-    def lex_score(self, word):
+            lines = f.read().splitlines()
+
+        lex = {}
+        total = 0
+        for line in lines:
+            word, count = line.split()[:2]
+            count = int(count)
+            if len(word) >= self.CASE_SENSITIVITY_THRESHOLD:
+                word = word.lower()
+            lex[word] = lex.get(word, lamb) + count
+            total += count
+        # Add out-of-lexicon word
+        lex[self.OOV] = lamb
+
+        # Normalise all counts at once
+        counts = np.fromiter(lex.values(), dtype=np.float64, count=len(lex))
+        log_probs = np.log(counts / float(total + lamb * len(lex)))
+        return dict(zip(lex, log_probs.tolist()))
+
+    def score(self, word):
+        """Returns the tuple (lexicon log probability, character model log probability).
+
+        Equivalent to but cheaper than calling both lex_score() and char_score().
+        Not cached, callers such as LanguageIdentifier.score() cache the result.
+        """
+        lex_word = word
+        if len(word) >= self.CASE_SENSITIVITY_THRESHOLD:
+            lex_word = word.lower()
+        return self.lex.get(lex_word, self.oov_lex_log), self._char_score(word)
+
+    def _lex_score(self, word):
         """Returns the log probability of the given word according to the lexicon.
+
+        Use the cached lex_score() instead.
         """
         if len(word) >= self.CASE_SENSITIVITY_THRESHOLD:
                 word = word.lower()
-        return self.lex.get(word, self.lex[self.OOV])
+        return self.lex.get(word, self.oov_lex_log)
 
     def char_score(self, word, debug=False):
         """Returns the log probability of the given word according to the character model.
 
         Enabling <debug> allows inspecting individual transition probabilities.
         """
-        ngrams = self.word2ngrams(word, self.n)
-        logp = 0
-        # Add starting probability
-        if not ngrams[0] in self.start_prob.keys():
-            logp += self.start_prob[self.UNKNOWN]
-        else:
-            logp += self.start_prob[ngrams[0]]
-        debugstr = word + " " + str(logp)
-        # Add transition probabilities
-        for i in range(len(ngrams)-1):
-            if not ngrams[i] in self.trans_prob.keys():
-                logp += self.trans_prob[self.UNKNOWN][self.UNKNOWN]
-                debugstr += " " + ngrams[i] + " XX" + str(self.trans_prob[self.UNKNOWN][self.UNKNOWN])
-            elif not ngrams[i+1] in self.trans_prob[ngrams[i]].keys():
-                logp += self.trans_prob[ngrams[i]][self.UNKNOWN]
-                debugstr += " " + ngrams[i] + " X" + str(self.trans_prob[ngrams[i]][self.UNKNOWN])
+        if debug:
+            return self._char_score(word, debug)
+        return self._cached_char_score(word)
+
+    def _char_score(self, word, debug=False):
+        """Uncached implementation of char_score().
+        """
+        idx = self.word2ngram_ids(word)
+        K = self.unk_index + 1
+        log, ptr, cols = self._log_view, self._ptr_view, self._cols_view
+        bisect_left = bisect.bisect_left
+        # Add starting and transition probabilities. Indexing the memoryviews
+        # with plain ints avoids creating NumPy scalars for every ngram.
+        # The lookup is inlined from transition() as this is the hot loop.
+        logp = log[idx[0]]
+        for i, j in zip(idx, idx[1:]):
+            hi = ptr[i+1]
+            k = bisect_left(cols, j, ptr[i], hi)
+            if k < hi and cols[k] == j:
+                logp += log[2 * K + k]
             else:
-                logp += self.trans_prob[ngrams[i]][ngrams[i+1]]
-                debugstr += " " + ngrams[i] + " " + str(self.trans_prob[ngrams[i]][ngrams[i+1]])
+                logp += log[K + i]
         if debug:
+            ngrams = self.word2ngrams(word, self.n)
+            debugstr = word + " " + str(log[idx[0]])
+            for i in range(len(ngrams)-1):
+                trans, seen = self.transition(idx[i], idx[i+1])
+                # Unseen ngrams are marked with XX, unseen transitions with X
+                if idx[i] == self.unk_index:
+                    mark = " XX"
+                elif not seen:
+                    mark = " X"
+                else:
+                    mark = " "
+                debugstr += " " + ngrams[i] + mark + str(trans)
             print(debugstr)
         return logp
 
@@ -152,13 +357,9 @@ class LanguageModel:
         # Total number of tokens.
         token_total = 0
         # Counts of how often each ngram occurs at the start of a token.
-        start_count = {}
-        # Counts of transitions between ngrams.
-        # This is a nested dictionary, e.g. trans_count["bai"]["ail"]
-        trans_count = {}
-        # Total number of transitions from each ngram (i.e. ngram count excluding
-        # sequence-final ngrams).
-        trans_total = {}
+        start_count = Counter()
+        # Counts of transitions between ngrams, keyed by (ngram, next_ngram).
+        trans_count = Counter()
         # Set of all characters.
         charset = set()
 
@@ -168,19 +369,27 @@ class LanguageModel:
         # Calculate counts
         with codecs.open(self.lex_file, encoding='utf-8') as f:
             for line in f:
-                fields = line.strip().split()
+                fields = line.split()
                 token = self.START + fields[0] + self.END
                 token_count = int(fields[1])
                 token_total += token_count
-                charset.update(list(token))
+                charset.update(token)
                 # Increase start counter
-                start_count[token[:n]] = start_count.get(token[:n], lamb) + token_count
+                start_count[token[:n]] += token_count
                 # Increase transition counter
-                for i in range(len(token) - n):
-                    if not token[i:i+n] in trans_count.keys():
-                        trans_count[token[i:i+n]] = {}
-                    trans_count[token[i:i+n]][token[i+1:i+n+1]] = trans_count[token[i:i+n]].get(token[i+1:i+n+1], lamb) + token_count
-                    trans_total[token[i:i+n]] = trans_total.get(token[i:i+n], 0) + token_count
+                ngrams = [token[i:i+n] for i in range(len(token) - n + 1)]
+                for transition in zip(ngrams, ngrams[1:]):
+                    trans_count[transition] += token_count
+
+        # Group transition counts by the first ngram.
+        # This is a nested dictionary, e.g. next_count["bai"]["ail"]
+        next_count = {}
+        # Total number of transitions from each ngram (i.e. ngram count excluding
+        # sequence-final ngrams).
+        trans_total = Counter()
+        for (ngram, next_ngram), count in trans_count.items():
+            next_count.setdefault(ngram, {})[next_ngram] = count
+            trans_total[ngram] += count
 
         # Smoothing for unseen ngrams
         self.trans_prob[self.UNKNOWN] = {}
@@ -188,17 +397,17 @@ class LanguageModel:
 
         # Calculate starting probabilities
         denominator = token_total + lamb * (len(start_count) + 1)
-        for ngram in start_count.keys():
-            self.start_prob[ngram] = math.log(start_count[ngram] / denominator)
+        for ngram, count in start_count.items():
+            self.start_prob[ngram] = math.log((count + lamb) / denominator)
         self.start_prob[self.UNKNOWN] = math.log(lamb / denominator)
 
         # Calculate transition probabilities
-        for ngram in trans_count.keys():
+        for ngram, row in next_count.items():
             self.trans_prob[ngram] = {}
-            denominator = (trans_total[ngram]) + lamb * (len(trans_count[ngram]) + 1)
-            for next_ngram in trans_count[ngram].keys():
-                self.trans_prob[ngram][next_ngram] = math.log(
-                    trans_count[ngram][next_ngram] / denominator)
+            denominator = (trans_total[ngram]) + lamb * (len(row) + 1)
+            for next_ngram, count in row.items():
+                self.trans_prob[ngram][next_ngram] = math.log((count + lamb) / denominator)
             self.trans_prob[ngram][self.UNKNOWN] = math.log(lamb / denominator)
 
+        self.index_ngrams()
         print("Model trained on %d tokens" % token_total)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional, without it the forward pass runs as plain Python.
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+@njit(cache=True)
+def viterbi_forward(E, log_trans, log_start):
+    """Viterbi forward pass over a sequence of emission scores for 2 states.
+
+    The loops over previous and current state are unrolled, so each token
+    only takes four additions and two comparisons.
+
+    Args:
+        E (float[T, 2]): Log emission scores of each token for each state.
+        log_trans (float[2, 2]): Log transition probabilities from state i to j.
+        log_start (float[2]): Log start probabilities of each state.
+
+    Returns:
+        v (float[2]): Max log probability of each state for the final token.
+        bp (int8[T, 2]): Backpointers, i.e. the most likely previous state.
+    """
+    T = E.shape[0]
+    bp = np.zeros((T, 2), dtype=np.int8)
+    t00, t01 = log_trans[0, 0], log_trans[0, 1]
+    t10, t11 = log_trans[1, 0], log_trans[1, 1]
+    v0 = log_start[0] + E[0, 0]
+    v1 = log_start[1] + E[0, 1]
+    for t in range(1, T):
+        # Ties go to state 0, like argmax
+        a0 = v0 + t00
+        b0 = v1 + t10
+        a1 = v0 + t01
+        b1 = v1 + t11
+        if a0 >= b0:
+            w0 = a0
+        else:
+            w0 = b0
+            bp[t, 0] = 1
+        if a1 >= b1:
+            w1 = a1
+        else:
+            w1 = b1
+            bp[t, 1] = 1
+        v0 = w0 + E[t, 0]
+        v1 = w1 + E[t, 1]
+    return np.array([v0, v1]), bp
@@ -22,9 +22,9 @@ identifier = LanguageIdentifier(fr, en,
 sentences = ["The name of the State is Éire or in the English language Ireland",
              "Dáil Éireann shall be summoned and dissolved by the President on the advice of the Taoiseach",
              "táim ag dul ar tinder date"]
-sentences = map(lambda x: x.split(), sentences)
+sentences = [sentence.split() for sentence in sentences]
 
-for tokens in sentences:
+for tokens, languages in zip(sentences, identifier.identify_many(sentences)):
     print(" ".join(tokens))
-    print(list(zip(tokens, identifier.identify(tokens))))
+    print(list(zip(tokens, languages)))
     print(" ")